@@ -45,7 +45,8 @@ class ANIRep(object):
         check_dependencies(dependencies)
 
 
-    def run(self, genomes, no_mash, mash_d, out_dir, prefix, mash_k, mash_v, mash_s, min_af, mash_db):
+    def run(self, genomes, no_mash, mash_d, out_dir, prefix, mash_k, mash_v, mash_s, min_af, mash_db,
+            mash_top_k=None, write_mash_distances=False):
         """Runs the pipeline.
 
         Parameters
@@ -70,11 +71,17 @@ class ANIRep(object):
             alignment fraction to consider the closest genomes
         mash_db : Optional[str]
             The path to read/write the pre-computed Mash reference sketch database.
+        mash_top_k : Optional[int]
+            If set, only compare this many of the closest reference genomes to each genome.
+        write_mash_distances : bool
+            True if the raw Mash distances should be written to disk.
         """
         max_mash_dist = mash_d
         fastani_results = self.run_mash_fastani(genomes, no_mash, mash_d, out_dir,
                                                 prefix, mash_k, mash_v,
-                                                mash_s, max_mash_dist, mash_db=mash_db)
+                                                mash_s, max_mash_dist, mash_db=mash_db,
+                                                mash_top_k=mash_top_k,
+                                                write_mash_distances=write_mash_distances)
 
         taxonomy = Taxonomy().read(TAXONOMY_FILE, canonical_ids=True)
         ani_summary_file = ANISummaryFile(out_dir, prefix, fastani_results, taxonomy)
@@ -86,7 +93,8 @@ class ANIRep(object):
                        min_af,
                        taxonomy)
 
-    def run_mash_fastani(self,genomes, no_mash, max_d, out_dir, prefix, mash_k, mash_v, mash_s, mash_max_dist=100, mash_db=None):
+    def run_mash_fastani(self,genomes, no_mash, max_d, out_dir, prefix, mash_k, mash_v, mash_s, mash_max_dist=100, mash_db=None,
+                         mash_top_k=None, write_mash_distances=False):
         """Runs the mash and fastani pipeline.
         This step is separated from the run function because it is called from 2 different
         functions in the gtdbtk ( classify and ani_reps).
@@ -113,6 +121,10 @@ class ANIRep(object):
             alignment fraction to consider the closest genome
         mash_db : Optional[str]
             The path to read/write the pre-computed Mash reference sketch database.
+        mash_top_k : Optional[int]
+            If set, only compare this many of the closest reference genomes to each genome.
+        write_mash_distances : bool
+            True if the raw Mash distances should be written to disk.
         """
         self.check_dependencies(no_mash)
 
@@ -128,9 +140,10 @@ class ANIRep(object):
 
             mash = Mash(self.cpus, dir_mash, prefix)
             self.logger.info(f'Using Mash version {mash.version()}')
-            mash_results = mash.run(genomes, ref_genomes, max_d, mash_k, mash_v, mash_s, mash_max_dist, mash_db)
-            for qry_gid, ref_hits in mash_results.items():
-                d_compare[qry_gid] = d_compare[qry_gid].union(set(ref_hits.keys()))
+            mash_results = mash.run(genomes, ref_genomes, max_d, mash_k, mash_v, mash_s, mash_max_dist, mash_db,
+                                   top_k=mash_top_k, write_mash_distances=write_mash_distances)
+            for qry_gid, ref_gid in mash_results:
+                d_compare[qry_gid].add(ref_gid)
 
         # Compare against all reference genomes.
         else:
@@ -27,7 +27,8 @@ class ANIScreener(object):
         self.cpus = cpus
         self.gtdb_radii = GTDBRadiiFile()
 
-    def run_aniscreen(self,genomes, no_mash,out_dir,prefix, mash_k, mash_v, mash_s, mash_max_dist, mash_db):
+    def run_aniscreen(self,genomes, no_mash,out_dir,prefix, mash_k, mash_v, mash_s, mash_max_dist, mash_db,
+                      mash_top_k=None, write_mash_distances=False):
 
         # If prescreen is set to True, then we will first run all genomes against a mash database
         # of all genomes in the reference package. The next step will be to classify those genomes with
@@ -47,7 +48,8 @@ class ANIScreener(object):
         ani_rep = ANIRep(self.cpus)
         # we store all the mash information in the classify directory
         fastani_results = ani_rep.run_mash_fastani(genomes, no_mash, mash_d, os.path.join(out_dir, DIR_ANISCREEN),
-                                                    prefix, mash_k, mash_v, mash_s, mash_max_dist, mash_db)
+                                                    prefix, mash_k, mash_v, mash_s, mash_max_dist, mash_db,
+                                                    mash_top_k, write_mash_distances)
 
         taxonomy = Taxonomy().read(TAXONOMY_FILE, canonical_ids=True)
 
@@ -338,6 +338,8 @@ class Classify(object):
             mash_s=Config.MASH_S_VALUE,
             mash_max_dist=Config.MASH_MAX_DISTANCE,
             mash_db=None,
+            mash_top_k=None,
+            write_mash_distances=False,
             ani_summary_files=None,
             all_classified_ani=False):
         """Classify genomes based on position in reference tree."""
@@ -367,7 +369,8 @@ class Classify(object):
 
             ani_rep = ANIRep(self.cpus)
             # we store all the mash information in the classify directory
-            fastani_results = ani_rep.run_mash_fastani(genomes, no_mash, mash_d, os.path.join(out_dir, DIR_ANISCREEN), prefix, mash_k, mash_v, mash_s,mash_max_dist, mash_db )
+            fastani_results = ani_rep.run_mash_fastani(genomes, no_mash, mash_d, os.path.join(out_dir, DIR_ANISCREEN), prefix, mash_k, mash_v, mash_s,mash_max_dist, mash_db,
+                                                       mash_top_k, write_mash_distances)
 
             mash_classified_user_genomes = self._sort_fastani_results_pre_pplacer(
                 fastani_results,bac_ar_diff)
@@ -283,6 +283,17 @@ def __mash_db(group):
                        help='path to save/read (if exists) the Mash reference sketch database (.msh)')
 
 
+def __mash_top_k(group):
+    group.add_argument('--mash_top_k', default=None, type=int,
+                       help='maximum number of the closest reference genomes (by Mash distance) '
+                            'to compare against each genome using FastANI')
+
+
+def __write_mash_distances(group):
+    group.add_argument('--write_mash_distances', default=False, action='store_true',
+                       help='output the raw Mash distances (disables re-use of distances from a previous run)')
+
+
 def __min_af(group):
     group.add_argument('--min_af', type=float, default=AF_THRESHOLD,
                        help='minimum alignment fraction to assign genome to a species cluster')
@@ -382,6 +393,8 @@ def get_main_parser():
             __mash_s(grp)
             __mash_v(grp)
             __mash_max_distance(grp)
+            __mash_top_k(grp)
+            __write_mash_distances(grp)
         with arg_group(parser, 'optional arguments') as grp:
             __full_tree(grp)
             __extension(grp)
@@ -473,6 +486,8 @@ def get_main_parser():
             __mash_s(grp)
             __mash_v(grp)
             __mash_max_distance(grp)
+            __mash_top_k(grp)
+            __write_mash_distances(grp)
         with arg_group(parser, 'optional arguments') as grp:
             __extension(grp)
             __prefix(grp)
@@ -537,6 +552,8 @@ def get_main_parser():
             __mash_d(grp)
             __mash_v(grp)
             __mash_db(grp)
+            __mash_top_k(grp)
+            __write_mash_distances(grp)
         with arg_group(parser, 'optional FastANI arguments') as grp:
             __min_af(grp)
         with arg_group(parser, 'optional arguments') as grp:
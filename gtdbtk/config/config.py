@@ -194,6 +194,8 @@ MASH_S_VALUE = 5000
 MASH_MAX_DISTANCE = 0.1
 MASH_D_VALUE = MASH_MAX_DISTANCE
 MASH_V_VALUE = 1.0
+# The maximum number of concurrent mash dist processes, each holds the reference sketch in memory.
+MASH_DIST_MAX_PROCESSES = 4
 
 
 # MRCA RED VALUE
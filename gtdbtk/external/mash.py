@@ -1,15 +1,329 @@
+import functools
+import hashlib
+import heapq
+import json
 import logging
 import os
+import queue
 import re
+import selectors
 import subprocess
 import tempfile
+import threading
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from enum import Enum
 from typing import Tuple, Dict
 from gtdbtk.biolib_lite.common import make_sure_path_exists
+from gtdbtk.biolib_lite.execute import which
 from gtdbtk.exceptions import GTDBTkExit
 from gtdbtk.tools import tqdm_log
 import gtdbtk.config.config as Config
 
+# The start of a row of mash info -t output: hashes, length, path, comment.
+_INFO_RE = re.compile(rb'(\d+)\t(\d+)\t([^\t]+)\t')
+
+
+class SketchConsistency(Enum):
+    """The state of an existing sketch file relative to the input genomes."""
+    CONSISTENT = 'consistent'
+    EXTEND = 'extend'
+    INCOMPATIBLE = 'incompatible'
+
+
+def _basename(path):
+    """Returns the file name of a path, this is equivalent to os.path.basename
+    for str paths but avoids its overhead when called on every genome.
+
+    Parameters
+    ----------
+    path : str
+        The path to the file.
+    """
+    return path.rpartition(os.sep)[2]
+
+
+def _file_size(path):
+    """Returns the size of a file, or 0 if it is missing so that the error is
+    reported by Mash instead.
+
+    Parameters
+    ----------
+    path : str
+        The path to the file.
+    """
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _parse_dist(chunks, qry_ids, ref_ids, max_mash_dist, top_k=None):
+    """Parses the hits from the output of mash dist.
+
+    Parameters
+    ----------
+    chunks : Iterable[bytes]
+        The output of mash dist, each chunk only contains complete lines.
+    qry_ids : dict[bytes, str]
+        Maps the encoded path of each query genome to its genome id.
+    ref_ids : dict[bytes, str]
+        Maps the encoded file name of each reference genome to its genome id.
+    max_mash_dist : float
+        The maximum Mash distance to keep a hit.
+    top_k : Optional[int]
+        If set, only keep this many of the closest hits for each query.
+
+    Returns
+    -------
+    dict[(query_id, ref_id)] = (dist, p_val, shared_numerator, shared_denominator)
+    """
+    out = dict()
+    sep = os.sep.encode('utf-8')
+
+    # The closest hits to each query are kept in a heap of at most top_k,
+    # ordered so that the furthest hit is at the top.
+    heaps = defaultdict(list) if top_k is not None else None
+
+    for chunk in chunks:
+        # Each line is: ref, qry, dist, p-value, shared hashes (numerator/denominator).
+        for line in chunk.split(b'\n'):
+            try:
+                ref_id, qry_id, dist, p_val, shared = line.split(b'\t', 4)
+            except ValueError:
+                continue
+            dist = float(dist)
+            if dist <= max_mash_dist:
+                shared_n, shared_d = shared.split(b'/', 1)
+                ref_id = ref_ids[ref_id.rpartition(sep)[2]]
+                hit = (dist, float(p_val), int(shared_n), int(shared_d))
+                if heaps is None:
+                    out[(qry_ids[qry_id], ref_id)] = hit
+                    continue
+                heap = heaps[qry_ids[qry_id]]
+                if len(heap) < top_k:
+                    heapq.heappush(heap, (-dist, ref_id, hit))
+                elif -dist > heap[0][0]:
+                    heapq.heapreplace(heap, (-dist, ref_id, hit))
+
+    if heaps is not None:
+        for qry_id, heap in heaps.items():
+            for _, ref_id, hit in heap:
+                out[(qry_id, ref_id)] = hit
+    return out
+
+
+def _available_memory(path='/proc/meminfo'):
+    """Returns the memory available to start new processes without swapping.
+    Unlike the free memory, this includes the page cache that can be reclaimed.
+
+    Parameters
+    ----------
+    path : str
+        The path to the kernel memory statistics.
+
+    Returns
+    -------
+    Optional[int]
+        The available memory in bytes, or None if it could not be read.
+    """
+    try:
+        with open(path) as fh:
+            for line in fh:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _dist_processes(cpus, n_qry, n_ref, k, s):
+    """Returns the number of mash dist processes to run over the query genomes.
+
+    mash dist does not scale well beyond a few threads, but each process
+    holds its own copy of the reference sketch. Additional processes are only
+    run if there is enough available memory for all of them.
+
+    Parameters
+    ----------
+    cpus : int
+        The maximum number of CPUs available to Mash.
+    n_qry : int
+        The number of query genomes.
+    n_ref : int
+        The number of reference genomes.
+    k : int
+        The k-mer size.
+    s : int
+        Maximum number of non-redundant hashes.
+    """
+    n_proc = min(cpus, n_qry, Config.MASH_DIST_MAX_PROCESSES)
+    if n_proc <= 1:
+        return 1
+
+    # Hashes are stored in 32 bits if k <= 16, otherwise 64 bits. Allow the
+    # same again for everything else held by each process.
+    ref_bytes = 2 * n_ref * s * (4 if k <= 16 else 8)
+    free_bytes = _available_memory()
+    if free_bytes is None:
+        return 1
+    return max(min(n_proc, free_bytes // max(ref_bytes, 1)), 1)
+
+
+def _popen(args, **kwargs):
+    """Opens a Mash process, resolving the executable to its full path and
+    leaving file descriptors open so subprocess can use posix_spawn instead
+    of forking the (potentially very large) GTDB-Tk process. All pipes
+    opened by Python are non-inheritable, so none are leaked to the child.
+
+    Parameters
+    ----------
+    args : list[str]
+        The arguments to run, starting with the executable.
+    kwargs
+        Any additional arguments to subprocess.Popen.
+
+    Returns
+    -------
+    subprocess.Popen
+        The opened process.
+    """
+    executable = which(args[0])
+    if executable is not None:
+        args = [executable, *args[1:]]
+    return subprocess.Popen(args, close_fds=False, **kwargs)
+
+
+def _load_json(path, parse):
+    """Loads a JSON file written by a previous run.
+
+    Parameters
+    ----------
+    path : str
+        The path to the JSON file.
+    parse : Callable[[object], object]
+        Converts the loaded JSON, returning None if it can't be used.
+
+    Returns
+    -------
+    Optional[object]
+        The converted JSON, or None if the file is missing or invalid.
+    """
+    try:
+        with open(path) as fh:
+            return parse(json.load(fh))
+    except (OSError, ValueError, TypeError, KeyError):
+        return None
+
+
+def _write_json_atomic(path, data):
+    """Writes a JSON file by replacing it with a complete temporary file, so
+    that an interrupted write is never read by a subsequent run.
+
+    Parameters
+    ----------
+    path : str
+        The path to the JSON file.
+    data : object
+        The data to write.
+
+    Returns
+    -------
+    bool
+        True if the file was written, False otherwise.
+    """
+    path_tmp = f'{path}.tmp'
+    try:
+        with open(path_tmp, 'w') as fh:
+            json.dump(data, fh)
+        os.replace(path_tmp, path)
+        return True
+    except (OSError, TypeError, ValueError):
+        try:
+            os.remove(path_tmp)
+        except OSError:
+            pass
+        return False
+
+
+def _drain_stderr(proc):
+    """Reads stderr of a process on a separate thread so that the process can
+    never block on a full pipe.
+
+    Parameters
+    ----------
+    proc : subprocess.Popen
+        A process opened with stderr as a pipe (in binary mode).
+
+    Returns
+    -------
+    tuple[threading.Thread, list[bytes]]
+        The started thread, and the list stderr is added to once it is read.
+    """
+    stderr = list()
+    thread = threading.Thread(target=lambda: stderr.append(proc.stderr.read()), daemon=True)
+    thread.start()
+    return thread, stderr
+
+
+def _iter_stderr(proc, cancel=None):
+    """Yields each line written to stderr by a process as soon as it arrives.
+
+    Both pipes are polled and read without blocking on a full line, stdout is
+    drained and discarded so that the process can never stall on it.
+
+    Parameters
+    ----------
+    proc : subprocess.Popen
+        A process opened with stdout and stderr as pipes (in binary mode).
+    cancel : Optional[threading.Event]
+        If set, the process is killed once this event is set.
+
+    Yields
+    ------
+    str
+        A line written to stderr, including the trailing newline.
+    """
+    partial = b''
+    with selectors.DefaultSelector() as selector:
+        selector.register(proc.stdout, selectors.EVENT_READ)
+        selector.register(proc.stderr, selectors.EVENT_READ)
+        while selector.get_map():
+            if cancel is not None and cancel.is_set():
+                proc.kill()
+                cancel = None
+            for key, _ in selector.select(timeout=1):
+                chunk = os.read(key.fd, 64 * 1024)
+                if not chunk:
+                    selector.unregister(key.fileobj)
+                elif key.fileobj is proc.stderr:
+                    *lines, partial = (partial + chunk).split(b'\n')
+                    for line in lines:
+                        yield line.decode('utf-8', 'replace') + '\n'
+    if partial:
+        yield partial.decode('utf-8', 'replace')
+
+
+@functools.lru_cache(maxsize=None)
+def _mash_version():
+    """Returns the version of mash, or 'unknown' if not known. This is only
+    run once as the version won't change while GTDB-Tk is running."""
+    try:
+        proc = _popen(['mash', '--version'], stdout=subprocess.PIPE,
+                      stderr=subprocess.PIPE, encoding='utf-8')
+        try:
+            stdout, stderr = proc.communicate(timeout=5)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+            return 'unknown'
+        if len(stdout) > 0:
+            return stdout.strip()
+        else:
+            return 'unknown'
+    except Exception:
+        return 'unknown'
+
 
 class Mash(object):
     """Runs Mash against genomes."""
@@ -34,18 +348,10 @@ class Mash(object):
     @staticmethod
     def version():
         """Returns the version of mash, or 'unknown' if not known."""
-        try:
-            proc = subprocess.Popen(['mash', '--version'], stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE, encoding='utf-8')
-            stdout, stderr = proc.communicate()
-            if len(stdout) > 0:
-                return stdout.strip()
-            else:
-                return 'unknown'
-        except Exception:
-            return 'unknown'
+        return _mash_version()
 
-    def run(self, qry, ref, mash_d, mash_k, mash_v, mash_s, mash_max_dist, mash_db) -> Dict[str, Dict[str, Tuple[float, float, int, int]]]:
+    def run(self, qry, ref, mash_d, mash_k, mash_v, mash_s, mash_max_dist, mash_db,
+            top_k=None, write_mash_distances=False) -> Dict[Tuple[str, str], Tuple[float, float, int, int]]:
         """Run Mash on a set of reference and query genomes.
 
         Parameters
@@ -66,39 +372,70 @@ class Mash(object):
             The maximum Mash distance to consider a genome as a close match.
         mash_db : Optional[str]
             The path to read/write the pre-computed Mash reference sketch database.
+        top_k : Optional[int]
+            If set, only keep this many of the closest reference genomes per query.
+        write_mash_distances : bool
+            True if the raw output of mash dist should also be written to disk.
 
         Returns
         -------
-        dict[query_id][ref_id] = (dist, p_val, shared_numerator, shared_denominator)
+        dict[(query_id, ref_id)] = (dist, p_val, shared_numerator, shared_denominator)
         """
-        qry_sketch = QrySketchFile(qry, self.out_dir, self.prefix, self.cpus, mash_k, mash_s)
-        ref_sketch = RefSketchFile(ref, self.out_dir, self.prefix, self.cpus, mash_k, mash_s, mash_db)
+        if top_k is not None and top_k < 1:
+            raise GTDBTkExit(f'The number of closest Mash hits to keep must be at least 1: {top_k}')
+
+        qry_path = QrySketchFile.get_path(self.out_dir, self.prefix)
+        ref_path = RefSketchFile.get_path(self.out_dir, self.prefix, mash_db)
+        n_chunks = _dist_processes(self.cpus, len(qry), len(ref), mash_k, mash_s)
+        if self.cpus == 1 or os.path.isfile(qry_path) or os.path.isfile(ref_path):
+            qry_sketch = QrySketchFile(qry, self.out_dir, self.prefix, self.cpus, mash_k, mash_s,
+                                       n_chunks)
+            ref_sketch = RefSketchFile(ref, self.out_dir, self.prefix, self.cpus, mash_k, mash_s, mash_db)
+        else:
+            # Neither sketch exists, so sketch both at the same time and split
+            # the CPUs in proportion to the number of genomes in each. Only the
+            # progress of the (larger) reference sketch is shown.
+            qry_cpus = min(max(round(self.cpus * len(qry) / (len(qry) + len(ref))), 1), self.cpus)
+            ref_cpus = max(self.cpus - qry_cpus, 1)
+            make_sure_path_exists(self.out_dir)
+            cancel = threading.Event()
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                qry_future = executor.submit(QrySketchFile, qry, self.out_dir, self.prefix,
+                                             qry_cpus, mash_k, mash_s, n_chunks,
+                                             progress=False, cancel=cancel)
+                ref_future = executor.submit(RefSketchFile, ref, self.out_dir, self.prefix,
+                                             ref_cpus, mash_k, mash_s, mash_db, cancel=cancel)
+
+                # Stop the other sketch as soon as either fails.
+                try:
+                    for future in as_completed((qry_future, ref_future)):
+                        future.result()
+                except BaseException:
+                    cancel.set()
+                    raise
+                qry_sketch, ref_sketch = qry_future.result(), ref_future.result()
 
         # Generate an output file comparing the distances between these genomes.
         mash_dists = DistanceFile(qry_sketch, ref_sketch, self.out_dir, self.prefix,
-                                  self.cpus, max_d=mash_d, mash_v=mash_v)
-        results = mash_dists.read(mash_max_dist)
-
-        # mash_db can be moved from filesystem to filesystem, so we need to update the path in the mash_db to
-        # reflect the new location.
-        current_ref = {os.path.basename(v): v for v in ref.values()}
-
-        # Convert the results back to the accession
-        path_to_qry = {v: k for (k, v) in qry.items()}
-        path_to_ref = {v: k for (k, v) in ref.items()}
-        out = defaultdict(dict)
-        for qry_path, ref_hits in results.items():
-            for ref_path, hit in ref_hits.items():
-                current_ref_path = current_ref[ref_path]
-                out[path_to_qry[qry_path]][path_to_ref[current_ref_path]] = hit
-        return out
+                                  self.cpus, max_d=mash_d, mash_v=mash_v,
+                                  write_output=write_mash_distances)
+
+        # mash_db can be moved from filesystem to filesystem, so the hits are keyed
+        # by the reference file name, map it straight to the accession.
+        qry_path_to_id = {v: k for (k, v) in qry.items()}
+        ref_name_to_id = {_basename(v): k for (k, v) in ref.items()}
+        try:
+            return mash_dists.read(qry_path_to_id, ref_name_to_id, mash_max_dist, top_k)
+        finally:
+            qry_sketch.cleanup()
 
 
 class DistanceFile(object):
     """The resulting distance file from the mash dist command."""
     name = 'mash_distances.tsv'
+    name_cache = 'mash_distances.cache.json'
 
-    def __init__(self, qry_sketch, ref_sketch, root, prefix, cpus, max_d, mash_v ,):
+    def __init__(self, qry_sketch, ref_sketch, root, prefix, cpus, max_d, mash_v, write_output=False):
         """Create a new Mash distance file using these arguments.
 
         Parameters
@@ -117,51 +454,228 @@ class DistanceFile(object):
             The maximum distance to consider.
         mash_v : float
             The maximum value to consider.
+        write_output : bool
+            True if the raw output of mash dist should also be written to disk.
         """
         self.logger = logging.getLogger('timestamp')
         self.qry_sketch = qry_sketch
         self.ref_sketch = ref_sketch
         self.path = os.path.join(root, f'{prefix}.{self.name}')
+        self.path_cache = os.path.join(root, f'{prefix}.{self.name_cache}')
         self.cpus = cpus
         self.max_d = max_d
         self.mash_v = mash_v
+        self.write_output = write_output
 
-        self._calculate()
+    def _calculate(self, qry_path_to_id, ref_name_to_id, max_mash_dist, top_k):
+        """Runs mash dist and parses the hits directly from its output stream,
+        this avoids writing (and re-reading) the whole distance table.
 
-    def _calculate(self):
+        mash dist does not scale well beyond a few threads, so if the query
+        genomes were sketched in chunks, a mash dist process is run for each.
+        """
         self.logger.info('Calculating Mash distances.')
-        args = ['mash', 'dist', '-p', self.cpus, '-d', self.max_d, '-v',
-                self.mash_v, self.ref_sketch.path, self.qry_sketch.path]
+        qry_paths = self.qry_sketch.chunk_paths
+        out = dict()
+        lock = threading.Lock()
+
+        # Hits are keyed by the raw paths, so look them up without decoding.
+        qry_ids = {k.encode('utf-8'): v for (k, v) in qry_path_to_id.items()}
+        ref_ids = {k.encode('utf-8'): v for (k, v) in ref_name_to_id.items()}
+        f_out = open(self.path, 'wb') if self.write_output else None
+        try:
+            if len(qry_paths) == 1:
+                out = self._dist(qry_paths, self.cpus, qry_ids, ref_ids,
+                                 max_mash_dist, top_k, f_out, lock)
+            else:
+                cpus_per_proc = max(self.cpus // len(qry_paths), 1)
+                cancel = threading.Event()
+                with ThreadPoolExecutor(max_workers=len(qry_paths)) as executor:
+                    futures = [executor.submit(self._dist, [path], cpus_per_proc, qry_ids,
+                                               ref_ids, max_mash_dist, top_k, f_out, lock, cancel)
+                               for path in qry_paths]
+
+                    # Stop the other processes as soon as any fails.
+                    try:
+                        for future in as_completed(futures):
+                            out.update(future.result())
+                    except BaseException:
+                        cancel.set()
+                        raise
+        finally:
+            if f_out is not None:
+                f_out.close()
+        return out
+
+    def _dist(self, qry_args, cpus, qry_ids, ref_ids, max_mash_dist, top_k, f_out, lock,
+              cancel=None):
+        """Runs a single mash dist process against the reference sketch.
+
+        Parameters
+        ----------
+        qry_args : list[str]
+            The query sketch files passed to mash dist.
+        cpus : int
+            The number of CPUs available to this process.
+        qry_ids : dict[bytes, str]
+            Maps the encoded path of each query genome to its genome id.
+        ref_ids : dict[bytes, str]
+            Maps the encoded file name of each reference genome to its genome id.
+        max_mash_dist : float
+            The maximum Mash distance to keep a hit.
+        top_k : Optional[int]
+            If set, only keep this many of the closest hits for each query.
+        f_out : Optional[BinaryIO]
+            If set, the raw output of mash dist is also written here.
+        lock : threading.Lock
+            Guards writes to f_out as processes may be run concurrently.
+        cancel : Optional[threading.Event]
+            If set, the process is killed once this event is set.
+
+        Returns
+        -------
+        dict[(query_id, ref_id)] = (dist, p_val, shared_numerator, shared_denominator)
+        """
+        args = ['mash', 'dist', '-p', cpus, '-d', self.max_d, '-v',
+                self.mash_v, self.ref_sketch.path, *qry_args]
         args = list(map(str, args))
-        with open(self.path, 'w') as f_out:
-            proc = subprocess.Popen(args, stdout=f_out,
-                                    stderr=subprocess.PIPE, encoding='utf-8')
-            _, stderr = proc.communicate()
+        proc = _popen(args, stdout=subprocess.PIPE,
+                      stderr=subprocess.PIPE, bufsize=1024 * 1024)
+
+        # Read the output on a separate thread so that waiting on mash
+        # overlaps with parsing. Each chunk only contains complete lines.
+        chunks = queue.Queue(maxsize=16)
+
+        def read_chunks():
+            try:
+                partial = b''
+                for chunk in iter(lambda: proc.stdout.read(1024 * 1024), b''):
+                    chunk = partial + chunk
+                    end = chunk.rfind(b'\n') + 1
+                    partial = chunk[end:]
+                    if end > 0:
+                        chunks.put(chunk[:end])
+                if partial:
+                    chunks.put(partial)
+            finally:
+                chunks.put(None)
+
+        reader = threading.Thread(target=read_chunks, daemon=True)
+        reader.start()
+
+        err_reader, stderr = _drain_stderr(proc)
+
+        def iter_chunks():
+            while True:
+                if cancel is not None and cancel.is_set():
+                    raise GTDBTkExit('Mash dist was cancelled.')
+                try:
+                    chunk = chunks.get(timeout=1)
+                except queue.Empty:
+                    continue
+                if chunk is None:
+                    return
+                if f_out is not None:
+                    with lock:
+                        f_out.write(chunk)
+                yield chunk
+
+        try:
+            out = _parse_dist(iter_chunks(), qry_ids, ref_ids, max_mash_dist, top_k)
+        except BaseException:
+            # Drain the queue so that the reader is never left blocked on it.
+            proc.kill()
+            for _ in iter(chunks.get, None):
+                pass
+            raise
+        finally:
+            reader.join()
+            err_reader.join()
+            proc.wait()
+
         if proc.returncode != 0:
-            raise GTDBTkExit(f'Error running Mash dist: {proc.stderr.read()}')
+            stderr = b''.join(stderr).decode('utf-8', 'replace')
+            raise GTDBTkExit(f'Error running Mash dist: {stderr}')
+        return out
 
-    def read(self,max_mash_dist=100) -> Dict[str, Dict[str, Tuple[float, float, int, int]]]:
-        """Reads the results of the distance file.
+    def read(self, qry_path_to_id, ref_name_to_id, max_mash_dist=100,
+             top_k=None) -> Dict[Tuple[str, str], Tuple[float, float, int, int]]:
+        """Runs mash dist and reads the resulting distances.
+
+        Parameters
+        ----------
+        qry_path_to_id : dict[str, str]
+            Maps the path of each query genome to its genome id.
+        ref_name_to_id : dict[str, str]
+            Maps the file name of each reference genome to its genome id.
+        max_mash_dist : float
+            The maximum Mash distance to keep a hit.
+        top_k : Optional[int]
+            If set, only keep this many of the closest hits for each query.
 
         Returns
         -------
-        dict[query_id][ref_id] = (dist, p_val, shared_numerator, shared_denominator)
+        dict[(query_id, ref_id)] = (dist, p_val, shared_numerator, shared_denominator)
         """
-        out = defaultdict(dict)
-        with open(self.path, 'r') as fh:
-            hits = re.findall(r'(.+)\t(.+)\t(.+)\t(.+)\t(\d+)\/(\d+)\n', fh.read())
-        for ref_id, qry_id, dist, p_val, shared_n, shared_d in hits:
-            dist, p_val = float(dist), float(p_val)
-            if dist <= max_mash_dist:
-                shared_num, shared_den = int(shared_n), int(shared_d)
-                out[qry_id][os.path.basename(ref_id)] = (dist, p_val, shared_num, shared_den)
+        # The raw output is only available by running mash dist.
+        if self.write_output:
+            return self._calculate(qry_path_to_id, ref_name_to_id, max_mash_dist, top_k)
+
+        key = self._cache_key(qry_path_to_id, ref_name_to_id, max_mash_dist, top_k)
+        out = self._load_cache(key)
+        if out is None:
+            out = self._calculate(qry_path_to_id, ref_name_to_id, max_mash_dist, top_k)
+            self._write_cache(key, out)
+        else:
+            self.logger.info(f'Loading Mash distances from a previous run: {self.path_cache}')
         return out
 
+    def _cache_key(self, qry_path_to_id, ref_name_to_id, max_mash_dist, top_k):
+        """Returns a key which identifies the inputs to mash dist. The sketch
+        files are identified by their size and modification time.
+
+        Returns
+        -------
+        str
+            The SHA256 hex digest of the inputs.
+        """
+        key = hashlib.sha256()
+        for path in (self.qry_sketch.path, self.ref_sketch.path):
+            stat = os.stat(path)
+            key.update(f'{stat.st_size}\t{stat.st_mtime_ns}\n'.encode('utf-8'))
+        key.update(f'{self.max_d}\t{self.mash_v}\t{max_mash_dist}\t{top_k}\n'.encode('utf-8'))
+        for mapping in (qry_path_to_id, ref_name_to_id):
+            for k, v in sorted(mapping.items()):
+                key.update(f'{k}\t{v}\n'.encode('utf-8'))
+        return key.hexdigest()
+
+    def _load_cache(self, key):
+        """Loads the distances cached by a previous run with the same inputs.
+
+        Returns
+        -------
+        Optional[dict[(query_id, ref_id)] = (dist, p_val, shared_numerator, shared_denominator)]
+            None if there is no cache for these inputs.
+        """
+        def parse(data):
+            if data['key'] != key:
+                return None
+            return {(qry_id, ref_id): (dist, p_val, shared_num, shared_den)
+                    for qry_id, ref_id, dist, p_val, shared_num, shared_den in data['hits']}
+
+        return _load_json(self.path_cache, parse)
+
+    def _write_cache(self, key, hits):
+        """Caches the distances so that an identical run can skip mash dist."""
+        data = {'key': key, 'hits': [(*k, *v) for k, v in hits.items()]}
+        if not _write_json_atomic(self.path_cache, data):
+            self.logger.debug(f'Unable to write the Mash distance cache to: {self.path_cache}')
+
 
 class SketchFile(object):
     """Output files which are generated by mash sketch."""
 
-    def __init__(self, genomes, path, cpus, k, s):
+    def __init__(self, genomes, path, cpus, k, s, progress=True, cancel=None):
         """Create a sketch file for a given set of genomes.
 
         Parameters
@@ -176,15 +690,23 @@ class SketchFile(object):
             The k-mer size.
         s : int
             Maximum number of non-redundant hashes.
+        progress : bool
+            True if a progress bar should be shown while sketching.
+        cancel : Optional[threading.Event]
+            If set, sketching is stopped once this event is set.
         """
         self.logger = logging.getLogger('timestamp')
         self.genomes = genomes
         self.path = path
+        self.path_meta = f'{path}.meta.json'
         self.data = dict()
         self.args = dict()
         self.cpus = cpus
         self.k = k
         self.s = s
+        self.chunk_paths = [path]
+        self.progress = progress
+        self.cancel = cancel
 
         make_sure_path_exists(os.path.dirname(self.path))
 
@@ -192,7 +714,10 @@ class SketchFile(object):
         if os.path.isfile(self.path):
             self.logger.info(f'Loading data from existing Mash sketch file: {self.path}')
             self._load_metadata()
-            if not self._is_consistent():
+            consistency = self._is_consistent()
+            if consistency is SketchConsistency.EXTEND:
+                self._extend()
+            elif consistency is SketchConsistency.INCOMPATIBLE:
                 raise GTDBTkExit(f'The sketch file is not consistent with the '
                                  f'input genomes. Remove the existing sketch '
                                  f'file or specify a new output directory.')
@@ -202,52 +727,192 @@ class SketchFile(object):
 
     def _load_metadata(self):
         """Loads the metadata from an existing Mash sketch file."""
-        args = ['mash', 'info', '-t', self.path]
-        proc = subprocess.Popen(args, stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE, encoding='utf-8')
-        stdout, stderr = proc.communicate()
+        if self._load_metadata_cache():
+            return
+
+        self.data = self._read_info(self.path)
+        self._write_metadata_cache()
+
+    @staticmethod
+    def _read_info(path):
+        """Reads the metadata of each genome in a Mash sketch file.
+
+        Parameters
+        ----------
+        path : str
+            The path to the Mash sketch file.
+
+        Returns
+        -------
+        dict[str, tuple[int, int]]
+            The number of hashes and the length of each genome path.
+        """
+        args = ['mash', 'info', '-t', path]
+        proc = _popen(args, stdout=subprocess.PIPE,
+                      stderr=subprocess.PIPE, bufsize=1024 * 1024)
+
+        thread, stderr = _drain_stderr(proc)
+
+        out = dict()
+        for line in proc.stdout:
+            hit = _INFO_RE.match(line)
+            if hit is not None:
+                hashes, length, genome_path = hit.groups()
+                out[genome_path.decode('utf-8')] = (int(hashes), int(length))
+        thread.join()
+        proc.wait()
 
         if proc.returncode != 0:
-            raise GTDBTkExit(f'Error reading Mash sketch file {self.path}:\n{stderr}')
+            stderr = b''.join(stderr).decode('utf-8', 'replace')
+            raise GTDBTkExit(f'Error reading Mash sketch file {path}:\n{stderr}')
+        return out
+
+    def _load_metadata_cache(self):
+        """Loads the metadata cached from a previous run of mash info. The
+        cache is only used if the size and modification time of the sketch
+        file are identical to when it was written.
+
+        Returns
+        -------
+        bool
+            True if the cache was loaded, False if it is missing or stale.
+        """
+        stat = os.stat(self.path)
 
-        for hashes, length, path in re.findall(r'(\d+)\t(\d+)\t(.+)\t.+\n', stdout):
-            self.data[path] = (int(hashes), int(length))
+        def parse(meta):
+            if meta['size'] != stat.st_size or meta['mtime_ns'] != stat.st_mtime_ns:
+                return None
+            return {path: (int(hashes), int(length))
+                    for path, (hashes, length) in meta['data'].items()}
+
+        data = _load_json(self.path_meta, parse)
+        self.data = data if data is not None else dict()
+        return data is not None
+
+    def _write_metadata_cache(self):
+        """Caches the metadata next to the sketch file to skip mash info on
+        subsequent runs. This is not possible if the directory is read-only."""
+        stat = os.stat(self.path)
+        meta = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'data': self.data}
+        if not _write_json_atomic(self.path_meta, meta):
+            self.logger.debug(f'Unable to write the Mash sketch metadata to: {self.path_meta}')
 
     def _is_consistent(self):
-        """Returns True if the sketch was generated from the genomes."""
+        """Compares the genomes in the sketch against the input genomes.
+
+        Returns
+        -------
+        SketchConsistency
+            CONSISTENT if the sketch was generated from the genomes, EXTEND if
+            the genomes only add to those in the sketch, otherwise INCOMPATIBLE.
+        """
         # to compare the consistency of the sketch file, we need to compare only the file names, not the full paths
         # the mash_db can be moves to another folder in the cloud so the full path will be different
-        data_keys = set(map(os.path.basename,self.data.keys()))
-        genomes_values = set(map(os.path.basename,self.genomes.values()))
-        return data_keys == genomes_values
+        data_keys = set(map(_basename, self.data.keys()))
+        genomes_values = set(map(_basename, self.genomes.values()))
+        if data_keys == genomes_values:
+            return SketchConsistency.CONSISTENT
+        if data_keys and data_keys < genomes_values:
+            return SketchConsistency.EXTEND
+        return SketchConsistency.INCOMPATIBLE
+
+    def _extend(self):
+        """Sketches the genomes missing from the sketch file and adds them to it."""
+        data_keys = set(map(_basename, self.data.keys()))
+        new_paths = [path for path in self.genomes.values()
+                     if _basename(path) not in data_keys]
+        self.logger.info(f'Adding {len(new_paths):,} genome(s) to the existing '
+                         f'Mash sketch file: {self.path}')
+
+        with tempfile.TemporaryDirectory(prefix='gtdbtk_mash_tmp_') as dir_tmp:
+            path_delta = os.path.join(dir_tmp, 'delta.msh')
+            self._sketch(new_paths, path_delta)
+            data_delta = self._read_info(path_delta)
+            self._paste([self.path, path_delta], self.path)
+
+        self.data.update(data_delta)
+        self._write_metadata_cache()
+
+    def _paste(self, sketch_paths, path_out):
+        """Combines several sketch files into one.
+
+        Parameters
+        ----------
+        sketch_paths : list[str]
+            The paths to the sketch files to combine.
+        path_out : str
+            The path to write the combined sketch file to.
+        """
+        # Write next to the output so that it can be replaced atomically.
+        path_tmp = f'{path_out}.tmp.msh'
+        args = ['mash', 'paste', path_tmp, *sketch_paths]
+        proc = _popen(args, stdout=subprocess.PIPE,
+                      stderr=subprocess.PIPE, encoding='utf-8')
+        _, stderr = proc.communicate()
+        if proc.returncode != 0 or not os.path.isfile(path_tmp):
+            raise GTDBTkExit(f'Error combining Mash sketch files into {path_out}:\n{stderr}')
+        os.replace(path_tmp, path_out)
+
+    def cleanup(self):
+        """Removes any temporary files kept for the lifetime of the sketch."""
+        pass
 
     def _generate(self):
         """Generate a new sketch file."""
-        with tempfile.TemporaryDirectory(prefix='gtdbtk_mash_tmp_') as dir_tmp:
-            path_genomes = os.path.join(dir_tmp, 'genomes.txt')
-            with open(path_genomes, 'w') as fh:
-                for path in self.genomes.values():
-                    fh.write(f'{path}\n')
-
-            args = ['mash', 'sketch', '-l', '-p', self.cpus, path_genomes, '-o',
-                    self.path, '-k', self.k, '-s', self.s]
-            args = list(map(str, args))
-            proc = subprocess.Popen(args, stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE, encoding='utf-8')
-            with tqdm_log(total=len(self.genomes), unit='genome') as p_bar:
-                for line in iter(proc.stderr.readline, ''):
-                    if line.startswith('Sketching'):
-                        p_bar.update()
-            proc.wait()
+        self._sketch(self.genomes.values(), self.path)
 
-            if proc.returncode != 0 or not os.path.isfile(self.path):
-                raise GTDBTkExit(f'Error generating Mash sketch: {proc.stderr.read()}')
+    def _sketch(self, genome_paths, path_out, p_bar=None):
+        """Sketch a set of genomes using the parameters of this file.
+
+        Parameters
+        ----------
+        genome_paths : Collection[str]
+            The paths to the genomes to sketch.
+        path_out : str
+            The path to write the sketch file to.
+        p_bar : Optional[tqdm_log]
+            The progress bar to update, otherwise a new one is created.
+        """
+        if p_bar is None:
+            with tqdm_log(total=len(genome_paths), unit='genome', disable=not self.progress) as p_bar:
+                return self._sketch(genome_paths, path_out, p_bar)
+
+        # The list of genomes is given to mash on stdin rather than a file.
+        args = ['mash', 'sketch', '-l', '-p', self.cpus, '/dev/stdin', '-o',
+                path_out, '-k', self.k, '-s', self.s]
+        args = list(map(str, args))
+        proc = _popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                      stderr=subprocess.PIPE)
+
+        # Write on a separate thread as mash may write to stderr meanwhile.
+        def write_genomes():
+            try:
+                proc.stdin.write(('\n'.join(genome_paths) + '\n').encode('utf-8'))
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+
+        writer = threading.Thread(target=write_genomes, daemon=True)
+        writer.start()
+
+        # stderr is consumed by the progress bar, so keep any other messages.
+        stderr = list()
+        for line in _iter_stderr(proc, self.cancel):
+            if line.startswith('Sketching'):
+                p_bar.update()
+            else:
+                stderr.append(line)
+        writer.join()
+        proc.wait()
+
+        if proc.returncode != 0 or not os.path.isfile(path_out):
+            raise GTDBTkExit(f'Error generating Mash sketch: {"".join(stderr)}')
 
 
 class QrySketchFile(SketchFile):
     name = 'user_query_sketch.msh'
 
-    def __init__(self, genomes, root, prefix, cpus, k, s):
+    def __init__(self, genomes, root, prefix, cpus, k, s, n_chunks=1, progress=True, cancel=None):
         """Create a query file for a given set of genomes.
 
         Parameters
@@ -264,16 +929,65 @@ class QrySketchFile(SketchFile):
             The k-mer size.
         s : int
             Maximum number of non-redundant hashes.
+        n_chunks : int
+            If a new sketch file is generated, also keep the genomes sketched
+            in this many chunks so that they can be run through mash dist
+            concurrently.
+        progress : bool
+            True if a progress bar should be shown while sketching.
+        cancel : Optional[threading.Event]
+            If set, sketching is stopped once this event is set.
         """
-        path = os.path.join(root, f'{prefix}.{self.name}')
+        path = self.get_path(root, prefix)
+        self.n_chunks = max(min(n_chunks, len(genomes)), 1)
+        self.dir_chunks = None
+
+        super().__init__(genomes, path, cpus, k, s, progress, cancel)
+
+    def _generate(self):
+        """Generate a new sketch file. The genomes are ordered by size as
+        similar sized queries are then compared consecutively by mash dist."""
+        genome_paths = sorted(self.genomes.values(), key=_file_size)
+        if self.n_chunks == 1:
+            self._sketch(genome_paths, self.path)
+            return
+
+        # Sketch each chunk separately then combine them, the chunks are
+        # taken in turn from the sorted genomes so they are of similar size.
+        self.dir_chunks = tempfile.TemporaryDirectory(prefix='gtdbtk_mash_tmp_')
+        chunk_paths = [os.path.join(self.dir_chunks.name, f'chunk_{i}.msh')
+                       for i in range(self.n_chunks)]
+        with tqdm_log(total=len(genome_paths), unit='genome', disable=not self.progress) as p_bar:
+            for i, chunk_path in enumerate(chunk_paths):
+                self._sketch(genome_paths[i::self.n_chunks], chunk_path, p_bar)
+        self._paste(chunk_paths, self.path)
+        self.chunk_paths = chunk_paths
 
-        super().__init__(genomes, path, cpus, k, s)
+    def cleanup(self):
+        """Removes the chunked sketch files."""
+        if self.dir_chunks is not None:
+            self.dir_chunks.cleanup()
+            self.dir_chunks = None
+            self.chunk_paths = [self.path]
+
+    @classmethod
+    def get_path(cls, root, prefix):
+        """Returns the path to the query sketch file.
+
+        Parameters
+        ----------
+        root : str
+            The directory where the sketch file will be saved.
+        prefix : str
+            The prefix to use for this file.
+        """
+        return os.path.join(root, f'{prefix}.{cls.name}')
 
 
 class RefSketchFile(SketchFile):
     name = Config.MASH_SKETCH_FILE
 
-    def __init__(self, genomes, root, prefix, cpus, k, s, mash_db=None):
+    def __init__(self, genomes, root, prefix, cpus, k, s, mash_db=None, cancel=None):
         """Create a query file for a given set of genomes.
 
         Parameters
@@ -292,6 +1006,25 @@ class RefSketchFile(SketchFile):
             Maximum number of non-redundant hashes.
         mash_db : Optional[str]
             The path to read/write the pre-computed Mash reference sketch database.
+        cancel : Optional[threading.Event]
+            If set, sketching is stopped once this event is set.
+        """
+        path = self.get_path(root, prefix, mash_db)
+
+        super().__init__(genomes, path, cpus, k, s, cancel=cancel)
+
+    @classmethod
+    def get_path(cls, root, prefix, mash_db=None):
+        """Returns the path to the reference sketch file.
+
+        Parameters
+        ----------
+        root : str
+            The directory where the sketch file will be saved.
+        prefix : str
+            The prefix to use for this file.
+        mash_db : Optional[str]
+            The path to read/write the pre-computed Mash reference sketch database.
         """
         if mash_db is not None:
             export_msh = mash_db.rstrip('\\')
@@ -300,8 +1033,5 @@ class RefSketchFile(SketchFile):
             if os.path.isdir(export_msh):
                 raise GTDBTkExit(f"{export_msh} is a directory")
             make_sure_path_exists(os.path.dirname(export_msh))
-            path = export_msh
-        else:
-            path = os.path.join(root, f'{prefix}.{self.name}')
-
-        super().__init__(genomes, path, cpus, k, s)
+            return export_msh
+        return os.path.join(root, f'{prefix}.{cls.name}')
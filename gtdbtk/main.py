@@ -599,6 +599,8 @@ class OptionsParser(object):
                      mash_s=options.mash_s,
                      mash_db=options.mash_db,
                      mash_max_dist=options.mash_max_distance,
+                     mash_top_k=options.mash_top_k,
+                     write_mash_distances=options.write_mash_distances,
                      ani_summary_files=ani_summary_files,
                      all_classified_ani=all_classified_ani
                      )
@@ -674,7 +676,9 @@ class OptionsParser(object):
             mash_v=options.mash_v,
             mash_s=options.mash_s,
             mash_max_dist=options.mash_max_distance,
-            mash_db=options.mash_db)
+            mash_db=options.mash_db,
+            mash_top_k=options.mash_top_k,
+            write_mash_distances=options.write_mash_distances)
 
 
         self.logger.info('Done.')
@@ -893,7 +897,8 @@ class OptionsParser(object):
 
         ani_rep = ANIRep(options.cpus)
         ani_rep.run(genomes, options.no_mash, options.mash_d, options.out_dir, options.prefix,
-                    options.mash_k, options.mash_v, options.mash_s, options.min_af, options.mash_db)
+                    options.mash_k, options.mash_v, options.mash_s, options.min_af, options.mash_db,
+                    options.mash_top_k, options.write_mash_distances)
 
         self.logger.info('Done.')
 
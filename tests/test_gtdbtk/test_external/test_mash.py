@@ -0,0 +1,336 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import gtdbtk.config.config as Config
+import gtdbtk.external.mash as mash_module
+from gtdbtk.exceptions import GTDBTkExit
+from gtdbtk.external.mash import DistanceFile, Mash, QrySketchFile, SketchConsistency, SketchFile, \
+    _parse_dist, _available_memory, _dist_processes, _write_json_atomic
+
+
+class TestMash(unittest.TestCase):
+
+    def setUp(self):
+        self.dir_tmp = tempfile.mkdtemp(prefix='gtdbtk_tmp_')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_tmp)
+
+    def test_run_invalid_top_k(self):
+        mash = Mash(1, self.dir_tmp, 'gtdbtk')
+        for top_k in (0, -1):
+            with self.assertRaises(GTDBTkExit):
+                mash.run({'a': '/a.fna'}, {'b': '/b.fna'}, 0.1, 16, 1.0, 5000, 0.1, None, top_k=top_k)
+
+
+class TestDistanceFileCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dir_tmp = tempfile.mkdtemp(prefix='gtdbtk_tmp_')
+        self.qry_path = os.path.join(self.dir_tmp, 'qry.msh')
+        self.ref_path = os.path.join(self.dir_tmp, 'ref.msh')
+        for path in (self.qry_path, self.ref_path):
+            with open(path, 'wb') as fh:
+                fh.write(b'sketch')
+        self.dist_file = DistanceFile(SimpleNamespace(path=self.qry_path),
+                                      SimpleNamespace(path=self.ref_path),
+                                      self.dir_tmp, 'gtdbtk', 1, 0.1, 1.0)
+        self.qry_path_to_id = {'/qry/q1.fna': 'q1', '/qry/q2.fna': 'q2'}
+        self.ref_name_to_id = {'GCA_1.fna.gz': 'r1', 'GCA_2.fna.gz': 'r2'}
+        self.hits = {('q1', 'r1'): (0.05, 0.0, 500, 1000),
+                     ('q1', 'r2'): (0.01, 1e-10, 900, 1000),
+                     ('q2', 'r2'): (0.03, 3e-10, 700, 1000)}
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_tmp)
+
+    def _key(self, max_mash_dist=0.1, top_k=None, qry_path_to_id=None, ref_name_to_id=None):
+        return self.dist_file._cache_key(qry_path_to_id or self.qry_path_to_id,
+                                         ref_name_to_id or self.ref_name_to_id,
+                                         max_mash_dist, top_k)
+
+    def test_round_trip(self):
+        """Test that the cached hits are loaded with the same types."""
+        key = self._key()
+        self.dist_file._write_cache(key, self.hits)
+        result = self.dist_file._load_cache(key)
+        self.assertDictEqual(result, self.hits)
+        for (qry_id, ref_id), (dist, p_val, shared_num, shared_den) in result.items():
+            self.assertIsInstance(dist, float)
+            self.assertIsInstance(p_val, float)
+            self.assertIsInstance(shared_num, int)
+            self.assertIsInstance(shared_den, int)
+        self.assertFalse(os.path.exists(f'{self.dist_file.path_cache}.tmp'))
+
+    def test_key_mismatch(self):
+        key = self._key()
+        self.dist_file._write_cache(key, self.hits)
+        self.assertIsNone(self.dist_file._load_cache('other'))
+
+        self.assertNotEqual(self._key(max_mash_dist=0.05), key)
+        self.assertNotEqual(self._key(top_k=1), key)
+        self.assertNotEqual(self._key(qry_path_to_id={'/qry/q1.fna': 'q1'}), key)
+        self.assertNotEqual(self._key(ref_name_to_id={'GCA_1.fna.gz': 'r2', 'GCA_2.fna.gz': 'r1'}), key)
+        self.assertEqual(self._key(), key)
+
+    def test_key_sketch_changed(self):
+        key = self._key()
+        stat = os.stat(self.ref_path)
+        os.utime(self.ref_path, ns=(stat.st_atime_ns, stat.st_mtime_ns - 10 ** 9))
+        self.assertNotEqual(self._key(), key)
+
+        key = self._key()
+        mtime_ns = os.stat(self.qry_path).st_mtime_ns
+        with open(self.qry_path, 'ab') as fh:
+            fh.write(b'more')
+        os.utime(self.qry_path, ns=(mtime_ns, mtime_ns))
+        self.assertNotEqual(self._key(), key)
+
+    def test_load_invalid(self):
+        key = self._key()
+        self.assertIsNone(self.dist_file._load_cache(key))
+
+        with open(self.dist_file.path_cache, 'w') as fh:
+            fh.write('{"key": "')
+        self.assertIsNone(self.dist_file._load_cache(key))
+
+        with open(self.dist_file.path_cache, 'w') as fh:
+            json.dump({'key': key, 'hits': [['q1', 'r1', 0.05]]}, fh)
+        self.assertIsNone(self.dist_file._load_cache(key))
+
+    def test_write_json_atomic_failure(self):
+        """Test that a failed write keeps the existing file and removes the temporary file."""
+        path = os.path.join(self.dir_tmp, 'data.json')
+        self.assertTrue(_write_json_atomic(path, {'a': 1}))
+        self.assertFalse(_write_json_atomic(path, {'a': 2, 'b': object()}))
+        with open(path) as fh:
+            self.assertEqual(json.load(fh), {'a': 1})
+        self.assertFalse(os.path.exists(f'{path}.tmp'))
+
+
+class TestDistProcesses(unittest.TestCase):
+
+    def setUp(self):
+        self.dir_tmp = tempfile.mkdtemp(prefix='gtdbtk_tmp_')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_tmp)
+
+    def test_available_memory(self):
+        path = os.path.join(self.dir_tmp, 'meminfo')
+        with open(path, 'w') as fh:
+            fh.write('MemTotal:       16000000 kB\n'
+                     'MemFree:          100000 kB\n'
+                     'MemAvailable:    8000000 kB\n')
+        self.assertEqual(_available_memory(path), 8000000 * 1024)
+
+    def test_available_memory_unknown(self):
+        path = os.path.join(self.dir_tmp, 'meminfo')
+        with open(path, 'w') as fh:
+            fh.write('MemTotal:       16000000 kB\n')
+        self.assertIsNone(_available_memory(path))
+        self.assertIsNone(_available_memory(os.path.join(self.dir_tmp, 'missing')))
+
+    @mock.patch.object(Config, 'MASH_DIST_MAX_PROCESSES', 4)
+    def test_dist_processes_caps(self):
+        with mock.patch.object(mash_module, '_available_memory', return_value=2 ** 50):
+            self.assertEqual(_dist_processes(1, 100, 1000, 16, 5000), 1)
+            self.assertEqual(_dist_processes(16, 1, 1000, 16, 5000), 1)
+            self.assertEqual(_dist_processes(16, 2, 1000, 16, 5000), 2)
+            self.assertEqual(_dist_processes(3, 100, 1000, 16, 5000), 3)
+            self.assertEqual(_dist_processes(16, 100, 1000, 16, 5000), 4)
+
+    @mock.patch.object(Config, 'MASH_DIST_MAX_PROCESSES', 4)
+    def test_dist_processes_memory(self):
+        """Test that each process must fit a copy of the reference sketch."""
+        ref_bytes = 2 * 1000 * 5000 * 4
+        with mock.patch.object(mash_module, '_available_memory', return_value=3 * ref_bytes):
+            self.assertEqual(_dist_processes(16, 100, 1000, 16, 5000), 3)
+            self.assertEqual(_dist_processes(16, 100, 1000, 21, 5000), 1)
+        with mock.patch.object(mash_module, '_available_memory', return_value=0):
+            self.assertEqual(_dist_processes(16, 100, 1000, 16, 5000), 1)
+
+    @mock.patch.object(Config, 'MASH_DIST_MAX_PROCESSES', 4)
+    def test_dist_processes_memory_unknown(self):
+        with mock.patch.object(mash_module, '_available_memory', return_value=None):
+            self.assertEqual(_dist_processes(16, 100, 1000, 16, 5000), 1)
+
+
+class TestQrySketchFile(unittest.TestCase):
+
+    def setUp(self):
+        self.dir_tmp = tempfile.mkdtemp(prefix='gtdbtk_tmp_')
+
+        # Genomes are written in reverse order of size to check they are sorted.
+        self.genomes = dict()
+        for i in range(5, 0, -1):
+            path = os.path.join(self.dir_tmp, f'genome_{i}.fna')
+            with open(path, 'w') as fh:
+                fh.write('A' * i * 10)
+            self.genomes[f'g{i}'] = path
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_tmp)
+
+    def _generate(self, n_chunks):
+        """Creates a query sketch file without running Mash."""
+        with mock.patch.object(QrySketchFile, '_sketch') as sketch, \
+                mock.patch.object(QrySketchFile, '_paste') as paste:
+            qry = QrySketchFile(self.genomes, self.dir_tmp, 'gtdbtk', 1, 16, 5000, n_chunks)
+        return qry, sketch, paste
+
+    def test_single_chunk(self):
+        qry, sketch, paste = self._generate(1)
+        sorted_paths = [self.genomes[f'g{i}'] for i in range(1, 6)]
+        sketch.assert_called_once_with(sorted_paths, qry.path)
+        paste.assert_not_called()
+        self.assertEqual(qry.chunk_paths, [qry.path])
+
+    def test_round_robin_chunks(self):
+        """Test that the chunks are taken in turn from the genomes sorted by size."""
+        qry, sketch, paste = self._generate(2)
+        self.assertEqual(len(qry.chunk_paths), 2)
+        self.assertEqual([c[0][:2] for c in sketch.call_args_list],
+                         [([self.genomes['g1'], self.genomes['g3'], self.genomes['g5']], qry.chunk_paths[0]),
+                          ([self.genomes['g2'], self.genomes['g4']], qry.chunk_paths[1])])
+        paste.assert_called_once_with(qry.chunk_paths, qry.path)
+
+        dir_chunks = os.path.dirname(qry.chunk_paths[0])
+        self.assertTrue(os.path.isdir(dir_chunks))
+        qry.cleanup()
+        self.assertFalse(os.path.isdir(dir_chunks))
+        self.assertEqual(qry.chunk_paths, [qry.path])
+
+    def test_n_chunks_clamped(self):
+        qry, sketch, _ = self._generate(8)
+        self.assertEqual(qry.n_chunks, 5)
+        self.assertEqual(sketch.call_count, 5)
+        qry.cleanup()
+
+        qry, sketch, _ = self._generate(0)
+        self.assertEqual(qry.n_chunks, 1)
+        self.assertEqual(qry.chunk_paths, [qry.path])
+
+
+class TestSketchFile(unittest.TestCase):
+
+    def setUp(self):
+        self.dir_tmp = tempfile.mkdtemp(prefix='gtdbtk_tmp_')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_tmp)
+
+    @staticmethod
+    def _sketch(data, genomes):
+        """Creates a sketch file with this metadata without running Mash."""
+        sketch = SketchFile.__new__(SketchFile)
+        sketch.data = data
+        sketch.genomes = genomes
+        return sketch
+
+    def _write_sketch(self, data):
+        """Writes a sketch file and its metadata cache, returning the path."""
+        path = QrySketchFile.get_path(self.dir_tmp, 'gtdbtk')
+        with open(path, 'wb') as fh:
+            fh.write(b'sketch')
+        stat = os.stat(path)
+        with open(f'{path}.meta.json', 'w') as fh:
+            json.dump({'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'data': data}, fh)
+        return path
+
+    def test_is_consistent_consistent(self):
+        data = {'/old/dir/a.fna': (1000, 5000), '/old/dir/b.fna': (1000, 6000)}
+        genomes = {'a': '/new/dir/a.fna', 'b': '/new/dir/b.fna'}
+        sketch = self._sketch(data, genomes)
+        self.assertEqual(sketch._is_consistent(), SketchConsistency.CONSISTENT)
+
+    def test_is_consistent_extend(self):
+        data = {'/old/dir/a.fna': (1000, 5000)}
+        genomes = {'a': '/new/dir/a.fna', 'b': '/new/dir/b.fna'}
+        sketch = self._sketch(data, genomes)
+        self.assertEqual(sketch._is_consistent(), SketchConsistency.EXTEND)
+
+    def test_is_consistent_incompatible(self):
+        data = {'/old/dir/a.fna': (1000, 5000), '/old/dir/c.fna': (1000, 6000)}
+        genomes = {'a': '/new/dir/a.fna', 'b': '/new/dir/b.fna'}
+        sketch = self._sketch(data, genomes)
+        self.assertEqual(sketch._is_consistent(), SketchConsistency.INCOMPATIBLE)
+
+    def test_is_consistent_empty_sketch(self):
+        genomes = {'a': '/new/dir/a.fna'}
+        self.assertEqual(self._sketch(dict(), genomes)._is_consistent(),
+                         SketchConsistency.INCOMPATIBLE)
+        self.assertEqual(self._sketch(dict(), dict())._is_consistent(),
+                         SketchConsistency.CONSISTENT)
+
+    def test_load_existing_consistent(self):
+        data = {'/old/dir/a.fna': [1000, 5000]}
+        self._write_sketch(data)
+        sketch = QrySketchFile({'a': '/new/dir/a.fna'}, self.dir_tmp, 'gtdbtk', 1, 16, 5000)
+        self.assertEqual(sketch.data, {'/old/dir/a.fna': (1000, 5000)})
+
+    def test_load_existing_incompatible(self):
+        data = {'/old/dir/a.fna': [1000, 5000]}
+        self._write_sketch(data)
+        with self.assertRaises(GTDBTkExit):
+            QrySketchFile({'b': '/new/dir/b.fna'}, self.dir_tmp, 'gtdbtk', 1, 16, 5000)
+
+
+class TestParseDist(unittest.TestCase):
+
+    def setUp(self):
+        self.qry_ids = {b'/qry/q1.fna': 'q1', b'/qry/q2.fna': 'q2'}
+        self.ref_ids = {b'GCA_1.fna.gz': 'r1', b'GCA_2.fna.gz': 'r2', b'GCA_3.fna.gz': 'r3'}
+        self.chunks = [b'/db/GCA_1.fna.gz\t/qry/q1.fna\t0.05\t0\t500/1000\n'
+                       b'/db/GCA_2.fna.gz\t/qry/q1.fna\t0.01\t1e-10\t900/1000\n',
+                       b'/db/GCA_3.fna.gz\t/qry/q1.fna\t0.02\t2e-10\t800/1000\n'
+                       b'/other/GCA_1.fna.gz\t/qry/q2.fna\t0.2\t0.5\t10/1000\n'
+                       b'/other/GCA_2.fna.gz\t/qry/q2.fna\t0.03\t3e-10\t700/1000\n']
+
+    def test_parse_dist(self):
+        """Test that hits are re-keyed by genome id and filtered by distance."""
+        result = _parse_dist(self.chunks, self.qry_ids, self.ref_ids, 0.1)
+        expected = {('q1', 'r1'): (0.05, 0.0, 500, 1000),
+                    ('q1', 'r2'): (0.01, 1e-10, 900, 1000),
+                    ('q1', 'r3'): (0.02, 2e-10, 800, 1000),
+                    ('q2', 'r2'): (0.03, 3e-10, 700, 1000)}
+        self.assertDictEqual(result, expected)
+
+    def test_parse_dist_empty(self):
+        self.assertDictEqual(_parse_dist([], self.qry_ids, self.ref_ids, 0.1), dict())
+        self.assertDictEqual(_parse_dist([b''], self.qry_ids, self.ref_ids, 0.1), dict())
+
+    def test_parse_dist_top_k(self):
+        """Test that only the closest top_k hits are kept for each query."""
+        result = _parse_dist(self.chunks, self.qry_ids, self.ref_ids, 0.1, top_k=2)
+        expected = {('q1', 'r2'): (0.01, 1e-10, 900, 1000),
+                    ('q1', 'r3'): (0.02, 2e-10, 800, 1000),
+                    ('q2', 'r2'): (0.03, 3e-10, 700, 1000)}
+        self.assertDictEqual(result, expected)
+
+        result = _parse_dist(self.chunks, self.qry_ids, self.ref_ids, 0.1, top_k=1)
+        self.assertEqual(set(result), {('q1', 'r2'), ('q2', 'r2')})
+
+        result = _parse_dist(self.chunks, self.qry_ids, self.ref_ids, 1.0, top_k=10)
+        self.assertEqual(result, _parse_dist(self.chunks, self.qry_ids, self.ref_ids, 1.0))